@@ -1,16 +1,23 @@
 import os
+import asyncio
+import numpy as np
 import pandas as pd
 import streamlit as st
 import pydeck as pdk
+from streamlit.components.v1 import html as components_html
 import openai
 import datetime
+import time
+import sqlite3
+import tempfile
+import threading
 from dotenv import load_dotenv
 
 # 🌍 Load environment variables
 load_dotenv()
 
 # 🎨 Custom CSS styling
-st.markdown("""
+CUSTOM_CSS = """
 <style>
     .stApp {
         background-color: #0e5669;
@@ -44,33 +51,297 @@ st.markdown("""
         color: #FFFFFF;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Streamlit drops any element a rerun doesn't redraw, so this is emitted once per run
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# ✅ Initialize OpenAI client (shared across reruns so its connection pool is reused)
+@st.cache_resource(show_spinner=False)
+def get_client():
+    return openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+GPT_MODEL = "gpt-3.5-turbo"
+GPT_CACHE_TTL = 3600  # seconds
+
+# 💾 Completed GPT responses keyed on (model, system, user), so repeat queries skip the API round-trip.
+# Kept as a shared dict rather than st.cache_data so first-time responses can still stream.
+@st.cache_resource(show_spinner=False)
+def gpt_cache():
+    return {}
+
+def cached_gpt(model, system, user):
+    entry = gpt_cache().get((model, system, user))
+    if entry is not None and time.time() - entry[0] < GPT_CACHE_TTL:
+        return entry[1]
+    return None
+
+def store_gpt(model, system, user, text):
+    cache = gpt_cache()
+    now = time.time()
+    for key in list(cache):
+        entry = cache.get(key)
+        if entry is not None and now - entry[0] >= GPT_CACHE_TTL:
+            cache.pop(key, None)
+    cache[(model, system, user)] = (now, text)
+
+def gpt_messages(system, user):
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
+    ]
+
+# 🔤 Pull the text out of a streamed chat completion
+def stream_text(stream):
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+# 🌊 Stream a GPT response token by token, or replay it whole from the cache
+def stream_gpt(model, system, user):
+    cached = cached_gpt(model, system, user)
+    if cached is not None:
+        yield cached
+        return
+
+    stream = get_client().chat.completions.create(
+        model=model,
+        messages=gpt_messages(system, user),
+        stream=True
+    )
+    parts = []
+    for text in stream_text(stream):
+        parts.append(text)
+        yield text
+    store_gpt(model, system, user, "".join(parts))
+
+# ⚡ Analyze several sites concurrently, one request per site, streaming each into its placeholder
+ANALYST_SYSTEM = "You are a helpful urban planning assistant."
+
+async def analyze_sites(prompts, placeholders):
+    # Unlike get_client(), the async client can't be cached across reruns: its connection pool
+    # is bound to the event loop, and each asyncio.run() closes its loop when it returns. So one
+    # client is opened per analysis; its connections are still reused across that run's sites.
+    async with openai.AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")) as aclient:
+        async def analyze(prompt, placeholder):
+            text = cached_gpt(GPT_MODEL, ANALYST_SYSTEM, prompt)
+            if text is None:
+                stream = await aclient.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=gpt_messages(ANALYST_SYSTEM, prompt),
+                    stream=True
+                )
+                text = ""
+                async for chunk in stream:
+                    if chunk.choices:
+                        text += chunk.choices[0].delta.content or ""
+                        placeholder.success(text)
+                store_gpt(GPT_MODEL, ANALYST_SYSTEM, prompt, text)
+            placeholder.success(text)
+            return text
+
+        return await asyncio.gather(*[analyze(prompt, placeholder) for prompt, placeholder in zip(prompts, placeholders)])
+
+# 📊 Load dataset (cached; the mtime argument invalidates the cache when the CSV changes)
+DATA_FILE = 'san_jose_eih_sites.csv'
+
+# Parse the CSV with pyarrow and keep a parquet copy alongside it for faster cold starts.
+# The copy records the CSV's mtime and is only reused when that matches exactly, so a CSV
+# swapped for one with an older timestamp isn't shadowed by a stale copy.
+def read_sites_file(path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        # pyarrow not installed: fall back to the default parser and skip the parquet cache
+        return pd.read_csv(path)
+
+    parquet_path = os.path.splitext(path)[0] + '.parquet'
+    source_mtime = repr(os.path.getmtime(path)).encode()
+    if os.path.exists(parquet_path):
+        try:
+            metadata = pq.read_schema(parquet_path).metadata or {}
+            if metadata.get(b'source_mtime') == source_mtime:
+                return pd.read_parquet(parquet_path)
+        except (OSError, ValueError):
+            pass  # unreadable copy: rebuild it below
+
+    df = pd.read_csv(path, engine='pyarrow')
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'source_mtime': source_mtime})
+
+    # Write to a temp file and swap it in, so a concurrent load never sees a half-written copy
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(parquet_path) or '.', suffix='.parquet.tmp')
+        os.close(fd)
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, parquet_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
+
+@st.cache_data(show_spinner=False)
+def load_sites(path, mtime):
+    df = read_sites_file(path)
+    # Rows need a position to be mapped and a name to be picked, labelled and indexed
+    df = df.dropna(subset=['latitude', 'longitude', 'site_name'])
+    # Narrow dtypes: float32 coordinates, smallest int for distances, categorical names.
+    # sentiment_score stays float64: it is shown as-is in the map tooltip and prompts, where
+    # float32 would print as 0.20000000298023224.
+    for col in ['latitude', 'longitude']:
+        df[col] = df[col].astype('float32')
+    for col in ['proximity_to_library', 'proximity_to_hospital']:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    df['site_name'] = df['site_name'].astype('category')
+    # Index rows by site name so selections are label lookups instead of full scans
+    # (unnamed, so it never clashes with the site_name column; duplicate names keep all rows)
+    df.index = pd.Index(df['site_name'].astype(str), name=None)
+    # Map centroid is fixed for a given dataset, so work it out once here
+    center = (
+        float(df['latitude'].to_numpy(dtype='float64').mean()),
+        float(df['longitude'].to_numpy(dtype='float64').mean())
+    )
+    return df, center
 
-# ✅ Initialize OpenAI client
-client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+data_mtime = os.path.getmtime(DATA_FILE)
+data, (lat_mean, lon_mean) = load_sites(DATA_FILE, data_mtime)
 
-# 📊 Load dataset
-data = pd.read_csv('san_jose_eih_sites.csv')
-data = data.dropna(subset=['latitude', 'longitude'])
+# 📋 Site names for the pickers (recomputed only when the dataset changes)
+@st.cache_data(show_spinner=False)
+def site_names(_df, data_version):
+    return sorted(_df['site_name'].unique().tolist())
 
 # ➕ Calculate Infrastructure Influence Score (IIS)
-def calculate_iis(row, w_sent, w_lib, w_hosp):
-    norm_sent = row['sentiment_score'] / 100
-    norm_lib = 1 - min(row['proximity_to_library'], 1000) / 1000
-    norm_hosp = 1 - min(row['proximity_to_hospital'], 1000) / 1000
+def calculate_iis_vec(df, w_sent, w_lib, w_hosp):
+    norm_sent = df['sentiment_score'].to_numpy() / 100.0
+    # Widen first: the distance columns may be downcast as far as int8, which can't hold the 1000 m cap
+    norm_lib = 1.0 - np.minimum(df['proximity_to_library'].to_numpy(dtype='float64'), 1000) / 1000.0
+    norm_hosp = 1.0 - np.minimum(df['proximity_to_hospital'].to_numpy(dtype='float64'), 1000) / 1000.0
     return (w_sent * norm_sent) + (w_lib * norm_lib) + (w_hosp * norm_hosp)
 
+# Caches keyed on the applied weights keep only the most recent few combinations,
+# since every distinct weighting would otherwise hold a full frame / map HTML forever
+WEIGHTS_CACHE_ENTRIES = 12
+
+# 🏷️ Add IIS score and suitability tag (cached per dataset version + weights).
+# The frame itself is passed unhashed; st.cache_resource hands back the shared result
+# without copying it, so callers treat it as read-only.
+@st.cache_resource(show_spinner=False, max_entries=WEIGHTS_CACHE_ENTRIES)
+def enrich(_df, data_version, w_sent, w_lib, w_hosp):
+    df = _df.copy()
+    score = calculate_iis_vec(df, w_sent, w_lib, w_hosp)
+    df['iis_score'] = score
+    df['suitability_tag'] = np.select(
+        [score >= 0.75, score >= 0.5],
+        ["🏅 Ideal", "👍 Moderate"],
+        default="⚠️ Poor"
+    )
+    return df
+
+# 📊 Community Pulse summary: top/bottom sentiment (partial sort) and average IIS
+@st.cache_data(show_spinner=False, max_entries=WEIGHTS_CACHE_ENTRIES)
+def pulse_tables(_df, data_version, weights):
+    return (
+        _df.nlargest(3, 'sentiment_score'),
+        _df.nsmallest(3, 'sentiment_score'),
+        float(_df['iis_score'].to_numpy().mean())
+    )
+
+# 🗺️ Build the pydeck map
+TOOLTIP_TEXT = """📍 Site: {site_name}
+🏫 Library: {proximity_to_library}m
+🏥 Hospital: {proximity_to_hospital}m
+💬 Sentiment Score: {sentiment_score}
+🔎 Suitability: {suitability_tag}"""
+
+HEXAGON_TOOLTIP_TEXT = "🏘️ Sites in area: {elevationValue}"
+
+# Above this many sites, per-point rendering gets sluggish, so aggregate on the GPU by default
+AGGREGATE_THRESHOLD = 5000
+
+# Position columns shipped to the browser; 5 decimal places (~1 m) keeps the JSON short.
+# Widen to float64 before rounding so float32 noise doesn't leak back into the JSON.
+POSITION_COLUMNS = ['longitude', 'latitude']
+COORD_DECIMALS = 5
+# Per-site fields the scatterplot tooltip reads; everything else stays server-side
+TOOLTIP_COLUMNS = ['site_name', 'proximity_to_library', 'proximity_to_hospital', 'sentiment_score', 'suitability_tag']
+
+def layer_data(df, aggregate=False):
+    positions = df[POSITION_COLUMNS].astype('float64').round(COORD_DECIMALS)
+    if aggregate:
+        # The hexagon bins only read positions, so send nothing else
+        return positions
+    map_df = df[TOOLTIP_COLUMNS].copy()
+    map_df[POSITION_COLUMNS] = positions
+    return map_df
+
+def build_deck(df, lat_mean, lon_mean, aggregate=False):
+    df = layer_data(df, aggregate)
+    if aggregate:
+        layer = pdk.Layer(
+            'HexagonLayer',
+            data=df,
+            get_position='[longitude, latitude]',
+            radius=100,
+            elevation_scale=4,
+            extruded=True,
+            coverage=1,
+            pickable=True
+        )
+        tooltip_text = HEXAGON_TOOLTIP_TEXT
+    else:
+        layer = pdk.Layer(
+            'ScatterplotLayer',
+            data=df,
+            get_position='[longitude, latitude]',
+            get_radius=200,
+            get_color='[200, 30, 0, 160]',
+            pickable=True
+        )
+        tooltip_text = TOOLTIP_TEXT
+
+    view_state = pdk.ViewState(
+        latitude=lat_mean,
+        longitude=lon_mean,
+        zoom=11,
+        pitch=45 if aggregate else 0
+    )
+
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        tooltip={"text": tooltip_text}
+    )
+
+# 🧾 Render the map to standalone HTML (embedding it is much smoother than st.pydeck_chart)
+@st.cache_data(show_spinner=False, max_entries=WEIGHTS_CACHE_ENTRIES)
+def build_deck_html(_df, data_version, weights, lat_mean, lon_mean, aggregate=False):
+    return build_deck(_df, lat_mean, lon_mean, aggregate).to_html(as_string=True)
+
+# 📝 Feedback store (one SQLite connection shared across reruns, with a lock since
+# every session thread writes through it)
+FEEDBACK_DB = 'site_feedback.db'
+
+@st.cache_resource(show_spinner=False)
+def feedback_conn():
+    conn = sqlite3.connect(FEEDBACK_DB, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS feedback (ts TEXT, site TEXT, body TEXT)")
+    conn.commit()
+    return conn, threading.Lock()
+
+# ⚖️ IIS weights (sentiment, library, hospital), committed from the AI Analysis tab
+DEFAULT_WEIGHTS = (0.33, 0.33, 0.34)
+if 'weights' not in st.session_state:
+    st.session_state.weights = DEFAULT_WEIGHTS
+
 # 🧭 Create tabs
 tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["🏠 Home", "🗺️ Map Viewer", "🧠 AI Site Analysis", "📊 Community Pulse", "🧩 Resident Matching", "📈 Post-Site Feedback"])
 
 # 🏠 HOME TAB
 with tab1:
     st.image("HomeFinderLogo.png", width=200)
-    st.markdown("""
-    <div style="text-align: center;">
-        <img src="HomeFinder Logo.png" width="200">
-    </div>
-    """, unsafe_allow_html=True)
 
     st.title("🏙️ San Jose EIH Site Explorer")
     st.markdown("Welcome to the **Emergency Interim Housing (EIH)** Site Explorer powered by AI.")
@@ -83,69 +354,32 @@ with tab1:
     - 📈 Track performance feedback post-deployment
     """)
 
-    file_path = 'san_jose_eih_sites.csv'
-    if os.path.exists(file_path):
-        modified_time = os.path.getmtime(file_path)
+    if os.path.exists(DATA_FILE):
+        modified_time = os.path.getmtime(DATA_FILE)
         st.info(f"📅 Dataset last updated: {datetime.datetime.fromtimestamp(modified_time).strftime('%Y-%m-%d %H:%M:%S')}")
 
     with st.expander("📂 Preview Raw Data Table"):
-        st.dataframe(data)
+        st.dataframe(data, hide_index=True)
 
 # 🗺️ MAP VIEWER TAB
 with tab2:
     st.header("📍 Interactive Map of Candidate EIH Sites")
 
-    weight_sentiment = 0.33
-    weight_library = 0.33
-    weight_hospital = 0.34
-    data['iis_score'] = data.apply(lambda row: calculate_iis(row, weight_sentiment, weight_library, weight_hospital), axis=1)
-
-    def tag_site(score):
-        if score >= 0.75:
-            return "🏅 Ideal"
-        elif score >= 0.5:
-            return "👍 Moderate"
-        else:
-            return "⚠️ Poor"
-
-    data['suitability_tag'] = data['iis_score'].apply(tag_site)
-
-    layer = pdk.Layer(
-        'ScatterplotLayer',
-        data=data,
-        get_position='[longitude, latitude]',
-        get_radius=200,
-        get_color='[200, 30, 0, 160]',
-        pickable=True
-    )
-
-    view_state = pdk.ViewState(
-        latitude=data['latitude'].mean(),
-        longitude=data['longitude'].mean(),
-        zoom=11,
-        pitch=0
-    )
+    weight_sentiment, weight_library, weight_hospital = st.session_state.weights
+    data = enrich(data, data_mtime, weight_sentiment, weight_library, weight_hospital)
 
-    tooltip_text = """📍 Site: {site_name}
-🏫 Library: {proximity_to_library}m
-🏥 Hospital: {proximity_to_hospital}m
-💬 Sentiment Score: {sentiment_score}
-🔎 Suitability: {suitability_tag}"""
+    aggregate = st.checkbox("🧊 Aggregate sites into hexagons", value=len(data) >= AGGREGATE_THRESHOLD)
 
-    r = pdk.Deck(
-        layers=[layer],
-        initial_view_state=view_state,
-        tooltip={"text": tooltip_text}
-    )
+    map_html = build_deck_html(data, data_mtime, st.session_state.weights, lat_mean, lon_mean, aggregate)
 
-    st.pydeck_chart(r)
+    components_html(map_html, height=620)
 
 # 🧠 AI ANALYSIS TAB
 with tab3:
     st.header("🔍 AI-Powered Site Analysis")
     st.markdown("Select one or more candidate sites below for analysis:")
 
-    selected = st.multiselect("📌 Choose sites to analyze:", options=data['site_name'].unique())
+    selected = st.multiselect("📌 Choose sites to analyze:", options=site_names(data, data_mtime))
 
     with st.expander("📘 About this AI Analysis"):
         st.markdown("""
@@ -156,21 +390,29 @@ with tab3:
         """)
 
     st.markdown("⚙️ **Customize Weighting** (optional)")
-    weight_sentiment = st.slider("Weight for Sentiment Score", 0.0, 1.0, 0.33)
-    weight_library = st.slider("Weight for Proximity to Library", 0.0, 1.0, 0.33)
-    weight_hospital = st.slider("Weight for Proximity to Hospital", 0.0, 1.0, 0.34)
+    # Sliders live in a form so dragging them doesn't rerun the app; weights only change on Apply
+    with st.form("weights_form"):
+        new_sentiment = st.slider("Weight for Sentiment Score", 0.0, 1.0, st.session_state.weights[0])
+        new_library = st.slider("Weight for Proximity to Library", 0.0, 1.0, st.session_state.weights[1])
+        new_hospital = st.slider("Weight for Proximity to Hospital", 0.0, 1.0, st.session_state.weights[2])
+        if st.form_submit_button("✅ Apply Weights"):
+            st.session_state.weights = (new_sentiment, new_library, new_hospital)
+            # The map and pulse tabs were already drawn with the old weights this run
+            st.rerun()
 
     if st.button("🚀 Run AI Analysis") and selected:
-        selected_data = data[data['site_name'].isin(selected)]
-        selected_data['iis_score'] = selected_data.apply(lambda row: calculate_iis(row, weight_sentiment, weight_library, weight_hospital), axis=1)
-
-        site_summary = ""
-        for _, row in selected_data.iterrows():
-            site_summary += (
-                f"- {row['site_name']}: Library {row['proximity_to_library']}m, "
-                f"Hospital {row['proximity_to_hospital']}m, "
-                f"Sentiment {row['sentiment_score']}, IIS Score: {row['iis_score']:.2f}\n"
+        selected_data = data.loc[selected]
+
+        site_lines = [
+            f"- {site}: Library {lib}m, Hospital {hosp}m, Sentiment {sent}, IIS Score: {iis:.2f}"
+            for site, lib, hosp, sent, iis in zip(
+                selected_data['site_name'].values,
+                selected_data['proximity_to_library'].values,
+                selected_data['proximity_to_hospital'].values,
+                selected_data['sentiment_score'].values,
+                selected_data['iis_score'].values
             )
+        ]
 
         weight_summary = f"""
 User-defined weights:
@@ -179,25 +421,22 @@ User-defined weights:
 - Hospital Proximity: {weight_hospital}
 """
 
-        prompt = f"""You are a policy analyst. Analyze the following Emergency Interim Housing (EIH) candidate sites based on proximity to infrastructure and resident sentiment. Recommend which sites seem more viable and why:
+        prompts = [f"""You are a policy analyst. Analyze the following Emergency Interim Housing (EIH) candidate site based on proximity to infrastructure and resident sentiment. Assess how viable it seems and why:
 
-{site_summary}
+{site_line}
 
 User-defined priority:
 {weight_summary}
 
-Be specific in your reasoning based on the numbers given."""
-
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful urban planning assistant."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+Be specific in your reasoning based on the numbers given.""" for site_line in site_lines]
 
         st.subheader("📈 AI Recommendation")
-        st.success(response.choices[0].message.content)
+        placeholders = []
+        for site in selected_data['site_name'].values:
+            st.markdown(f"**{site}**")
+            placeholders.append(st.empty())
+
+        asyncio.run(analyze_sites(prompts, placeholders))
 
 # 📊 COMMUNITY PULSE TAB
 with tab4:
@@ -205,14 +444,16 @@ with tab4:
 
     st.markdown("This view provides a high-level overview of sentiment and access to resources across the city.")
 
+    top_sites, bottom_sites, avg_iis = pulse_tables(data, data_mtime, st.session_state.weights)
+
     st.subheader("Top 3 Sites by Sentiment")
-    st.dataframe(data.sort_values(by="sentiment_score", ascending=False).head(3))
+    st.dataframe(top_sites, hide_index=True)
 
     st.subheader("Bottom 3 Sites by Sentiment")
-    st.dataframe(data.sort_values(by="sentiment_score", ascending=True).head(3))
+    st.dataframe(bottom_sites, hide_index=True)
 
     st.subheader("Average Infrastructure Influence Score (IIS)")
-    st.metric("Citywide Avg IIS", f"{data['iis_score'].mean():.2f}")
+    st.metric("Citywide Avg IIS", f"{avg_iis:.2f}")
 
 # 🧩 RESIDENT MATCHING TAB
 with tab5:
@@ -237,16 +478,12 @@ Site Options:
 
 Be thoughtful, empathetic, and specific."""
 
-        match_response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You match residents with appropriate temporary housing based on their needs."},
-                {"role": "user", "content": match_prompt}
-            ]
-        )
-
         st.subheader("🔗 Best Match Recommendation")
-        st.info(match_response.choices[0].message.content)
+        st.write_stream(stream_gpt(
+            GPT_MODEL,
+            "You match residents with appropriate temporary housing based on their needs.",
+            match_prompt
+        ))
 
 # 📈 FEEDBACK LOOP TAB
 with tab6:
@@ -254,11 +491,15 @@ with tab6:
 
     st.markdown("Use this section to log performance data or feedback about EIH sites post-deployment for future learning.")
 
-    feedback_site = st.selectbox("Select Site for Feedback:", data['site_name'].unique())
+    feedback_site = st.selectbox("Select Site for Feedback:", site_names(data, data_mtime))
     feedback = st.text_area("Enter qualitative or performance-based feedback:")
 
     if st.button("💾 Save Feedback"):
-        with open("site_feedback_log.txt", "a") as f:
-            f.write(f"\n{datetime.datetime.now()} | Site: {feedback_site} | Feedback: {feedback}")
+        conn, lock = feedback_conn()
+        with lock, conn:
+            conn.execute(
+                "INSERT INTO feedback (ts, site, body) VALUES (?, ?, ?)",
+                (datetime.datetime.now().isoformat(sep=' '), str(feedback_site), feedback)
+            )
         st.success("✅ Feedback logged. Thank you!")
 